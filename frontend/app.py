@@ -1,13 +1,25 @@
+import functools
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import streamlit as st
 import folium
-from streamlit_folium import st_folium
+from folium.plugins import FastMarkerCluster
+import streamlit.components.v1 as components
+
+# Acelera DBSCAN (SIMD + hilos) parcheando sklearn antes de deserializar
+# el modelo; si scikit-learn-intelex no está instalado, seguimos igual.
+try:
+    from sklearnex import patch_sklearn
+    patch_sklearn()
+except ImportError:
+    pass
+
 import joblib
 import matplotlib.cm as cm
 import matplotlib.colors as mcolors
-from sklearn.preprocessing import StandardScaler
 from twilio.rest import Client
 
 # =============================
@@ -35,32 +47,140 @@ def load_model():
 
 modelo = load_model()
 
+# =============================
+# UTIL: LECTURA DEL ARCHIVO
+# =============================
+def _coords_a_float32(df: pd.DataFrame) -> pd.DataFrame:
+    # La precisión GPS (~6 decimales) cabe de sobra en float32; bajar el
+    # ancho aquí reduce a la mitad los bytes que mueve DBSCAN más adelante
+    for c in df.columns:
+        nombre = str(c).strip().lower()
+        if nombre in ("latitud", "longitud") or "velocidad" in nombre:
+            df[c] = df[c].astype(np.float32)
+    return df
+
+def _leer_csv_parcial(file_bytes: bytes, n_rows: int) -> pd.DataFrame:
+    # Lectura en streaming con corte temprano: deja de tokenizar el CSV en
+    # cuanto se alcanzan las filas pedidas, sin recorrer el resto del archivo
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    lector = pacsv.open_csv(
+        io.BytesIO(file_bytes),
+        read_options=pacsv.ReadOptions(block_size=4 << 20),
+    )
+    lotes, leidas = [], 0
+    for lote in lector:
+        lotes.append(lote)
+        leidas += lote.num_rows
+        if leidas >= n_rows:
+            break
+    return pa.Table.from_batches(lotes).slice(0, n_rows).to_pandas()
+
+@st.cache_data(show_spinner=False)
+def parse_upload(file_bytes: bytes, name: str, n_rows: int = 0) -> pd.DataFrame:
+    # Cacheado por hash de los bytes: cada rerun de Streamlit (checkbox,
+    # number_input, etc.) reutiliza el DataFrame ya parseado.
+    # n_rows > 0 limita la lectura a las primeras N filas (vista previa).
+    if name.endswith(".xlsx"):
+        try:
+            # calamine (Rust) parsea el XLSX mucho más rápido que openpyxl
+            df = pd.read_excel(io.BytesIO(file_bytes), engine="calamine",
+                               nrows=n_rows or None)
+        except ImportError:
+            df = pd.read_excel(io.BytesIO(file_bytes), nrows=n_rows or None)
+        return _coords_a_float32(df)
+    if n_rows > 0:
+        try:
+            return _coords_a_float32(_leer_csv_parcial(file_bytes, n_rows))
+        except Exception:
+            return _coords_a_float32(
+                pd.read_csv(io.BytesIO(file_bytes), nrows=n_rows, low_memory=False)
+            )
+    # CSV: pyarrow tokeniza en paralelo y los dtypes explícitos evitan la
+    # inferencia en dos pasadas sobre las coordenadas.
+    dtypes = {"Latitud": "float32", "Longitud": "float32"}
+    try:
+        df = pd.read_csv(io.BytesIO(file_bytes), engine="pyarrow", dtype=dtypes)
+    except Exception:
+        df = pd.read_csv(io.BytesIO(file_bytes), low_memory=False)
+    return _coords_a_float32(df)
+
 # =============================
 # UTIL: MICRO-PARADAS
 # =============================
 def detectar_microparadas(df: pd.DataFrame, col_vel: str) -> pd.DataFrame:
-    df = df.copy()
-    df["alerta"] = df[col_vel].apply(lambda v: "⚠️" if v < 5 else "✅")
+    # Copia superficial: solo agregamos una columna, sin duplicar los datos
+    df = df.copy(deep=False)
+    # Comparación vectorizada (NumPy) en lugar de .apply fila por fila
+    vals = df[col_vel].to_numpy(dtype=np.float32, copy=False)
+    df["alerta"] = np.where(vals < 5.0, "⚠️", "✅")
     return df
 
+# =============================
+# UTIL: MARCADORES EN BLOQUE
+# =============================
+# Callback JS que FastMarkerCluster ejecuta en el navegador por cada fila
+# [lat, lon, color, popup]; evita crear un CircleMarker de Python por punto.
+_CALLBACK_CIRCULO = """
+function (row) {
+    return L.circleMarker([row[0], row[1]], {
+        radius: 5, color: row[2], fill: true, fillOpacity: 0.7
+    }).bindPopup(row[3]);
+}
+"""
+
+def agregar_marcadores(mapa, lats, lons, colors, popups):
+    datos = [list(fila) for fila in zip(lats.tolist(), lons.tolist(), colors.tolist(), popups)]
+    FastMarkerCluster(datos, callback=_CALLBACK_CIRCULO).add_to(mapa)
+
+@st.cache_data(show_spinner=False)
+def build_map_html(center, lats, lons, colors, popups) -> str:
+    # El HTML del mapa se cachea por contenido: los reruns que no tocan los
+    # datos (checkbox de SMS, etc.) no vuelven a construir el folium.Map
+    m = folium.Map(location=list(center), zoom_start=13)
+    agregar_marcadores(m, lats, lons, colors, popups)
+    return m.get_root().render()
+
 # =============================
 # UTIL: AGRUPAR CON DBSCAN
 # =============================
 def agrupar_con_modelo(df: pd.DataFrame, col_vel: str, model) -> pd.DataFrame:
-    df = df.copy()
-    features_df = df[["Latitud", "Longitud", col_vel]].astype(float)
-    # Escala por consistencia con el entrenamiento
-    scaler = StandardScaler()
-    X = scaler.fit_transform(features_df)
+    df = df.copy(deep=False)
+    # Z-score manual sobre un solo buffer float32, por consistencia con el
+    # entrenamiento pero sin las copias ni la validación de StandardScaler
+    X = df[["Latitud", "Longitud", col_vel]].to_numpy(dtype=np.float32, copy=True)
+    mu = X.mean(axis=0)
+    sd = X.std(axis=0)
+    sd[sd == 0] = 1.0
+    np.subtract(X, mu, out=X)
+    np.divide(X, sd, out=X)
     # Para DBSCAN usamos fit_predict (aplica eps/min_samples cargados)
-    etiquetas = model.fit_predict(X)
-    df["cluster"] = etiquetas
+    df["cluster"] = model.fit_predict(X)
     return df
 
+@st.cache_data(show_spinner=False)
+def compute_clusters(file_bytes: bytes, name: str, col_vel: str, _model,
+                     n_rows: int = 0) -> np.ndarray:
+    # Cacheado por (bytes del archivo, columna de velocidad): los reruns que
+    # solo tocan widgets no vuelven a correr DBSCAN. El modelo va con "_"
+    # para que Streamlit no intente hashearlo.
+    df = parse_upload(file_bytes, name, n_rows)
+    df.columns = [c.strip().replace("\n", " ") for c in df.columns]
+    return agrupar_con_modelo(df, col_vel, _model)["cluster"].to_numpy()
+
 # =============================
 # UTIL: TWILIO (lee secrets/env)
 # =============================
-def get_twilio_client_and_from():
+@st.cache_resource
+def _twilio_client(sid: str, token: str) -> Client:
+    # Un solo Client por proceso: reutiliza la sesión HTTP (keep-alive)
+    # entre mensajes y entre reruns en vez de rehacer el handshake TLS
+    return Client(sid, token)
+
+@functools.lru_cache(maxsize=1)
+def _twilio_config():
+    # Los secrets no cambian en vida del proceso: se resuelven una sola vez
     # 1) Intenta estructura seccionada: [twilio]
     try:
         sid = st.secrets["twilio"]["account_sid"]
@@ -71,10 +191,13 @@ def get_twilio_client_and_from():
         sid = st.secrets.get("TWILIO_ACCOUNT_SID", os.getenv("TWILIO_ACCOUNT_SID"))
         token = st.secrets.get("TWILIO_AUTH_TOKEN", os.getenv("TWILIO_AUTH_TOKEN"))
         from_num = st.secrets.get("TWILIO_FROM_NUMBER", os.getenv("TWILIO_FROM_NUMBER"))
+    return sid, token, from_num
 
+def get_twilio_client_and_from():
+    sid, token, from_num = _twilio_config()
     if not (sid and token and from_num):
         return None, None
-    return Client(sid, token), from_num
+    return _twilio_client(sid, token), from_num
 
 def get_default_to_number():
     try:
@@ -96,6 +219,12 @@ if modelo is None:
     st.stop()
 
 uploaded_file = st.file_uploader("Sube tu archivo de datos de GPS", type=["xlsx", "csv"])
+preview_rows = st.number_input(
+    "Filas a procesar (0 = archivo completo)",
+    min_value=0, value=0, step=10000,
+    help="Procesa solo las primeras N filas para explorar rápido un archivo "
+         "grande; deja 0 para el análisis completo.",
+)
 
 # --- Panel de Notificaciones por SMS (config) ---
 with st.expander("🔔 Notificación por SMS (Twilio)"):
@@ -112,11 +241,11 @@ if not uploaded_file:
     st.stop()
 
 # ---------- Lectura ----------
+# getvalue() una sola vez: los mismos bytes sirven de entrada al parser y
+# de clave de cache para el clustering, sin depender de la posición del buffer
+raw = uploaded_file.getvalue()
 try:
-    if uploaded_file.name.endswith(".xlsx"):
-        df = pd.read_excel(uploaded_file)
-    else:
-        df = pd.read_csv(uploaded_file)
+    df = parse_upload(raw, uploaded_file.name, int(preview_rows))
 except Exception as e:
     st.error(f"❌ Error leyendo el archivo: {e}")
     st.stop()
@@ -141,45 +270,88 @@ if "Latitud" not in df.columns or "Longitud" not in df.columns:
 st.subheader("🚗 Micro-Paradas (Velocidad < 5 km/h)")
 df_micro = detectar_microparadas(df, col_vel)
 
-m1 = folium.Map(location=[df_micro["Latitud"].mean(), df_micro["Longitud"].mean()], zoom_start=13)
-for _, row in df_micro.iterrows():
-    color = "red" if row["alerta"] == "⚠️" else "green"
-    popup = f"Velocidad: {row[col_vel]} km/h"
-    folium.CircleMarker(
-        location=[row["Latitud"], row["Longitud"]],
-        radius=5, color=color, fill=True, fill_opacity=0.7, popup=popup
-    ).add_to(m1)
-st_folium(m1, use_container_width=True)
+# Por encima de ~5k marcadores el navegador se vuelve inusable; muestreamos
+# con paso fijo para acotar los nodos DOM sin perder la forma del recorrido.
+MAX_MARKERS = 5000
+
+df_vis = df_micro.iloc[::max(1, len(df_micro) // MAX_MARKERS)]
+lats = df_vis["Latitud"].to_numpy()
+lons = df_vis["Longitud"].to_numpy()
+vels = df_vis[col_vel].to_numpy()
+colores_micro = np.where(vels < 5, "red", "green")
+# :.1f evita que el float32 ingerido se muestre con ruido de precisión
+# (12.3 → "12.300000190734863") al pasar por float de Python
+popups_micro = [f"Velocidad: {v:.1f} km/h" for v in vels.tolist()]
+components.html(
+    build_map_html(
+        (df_micro["Latitud"].mean(), df_micro["Longitud"].mean()),
+        lats, lons, colores_micro, popups_micro,
+    ),
+    height=500,
+)
 
 # ---------- DBSCAN ----------
 st.subheader("📊 Agrupación de Puntos Calientes con DBSCAN")
-df_cluster = agrupar_con_modelo(df, col_vel, modelo)
+labels_dbscan = compute_clusters(
+    raw, uploaded_file.name, col_vel, modelo, int(preview_rows)
+)
+df_cluster = df.copy(deep=False)
+df_cluster["cluster"] = labels_dbscan
+# Ordenar una vez por etiqueta deja cada cluster en memoria contigua, lo
+# que abarata el muestreo por cluster y la agregación posterior
+orden = np.argsort(labels_dbscan, kind="stable")
+df_cluster = df_cluster.iloc[orden].reset_index(drop=True)
 
-m2 = folium.Map(location=[df_cluster["Latitud"].mean(), df_cluster["Longitud"].mean()], zoom_start=13)
 unique_clusters = sorted(df_cluster["cluster"].unique())
-color_map = cm.get_cmap('tab10', max(1, len(unique_clusters)))
-cluster_colors = {c: mcolors.to_hex(color_map(i)) for i, c in enumerate(unique_clusters)}
-
-for _, row in df_cluster.iterrows():
-    c_id = row["cluster"]
-    color = "gray" if c_id == -1 else cluster_colors[c_id]
-    popup = f"Cluster: {c_id} | Velocidad: {row[col_vel]} km/h"
-    folium.CircleMarker(
-        location=[row["Latitud"], row["Longitud"]],
-        radius=5, color=color, fill=True, fill_opacity=0.7, popup=popup
-    ).add_to(m2)
-st_folium(m2, use_container_width=True)
+# Paleta como array indexable por id de cluster: un solo fancy-index
+# vectorizado en vez de una búsqueda de diccionario por punto
+n_colores = max(1, int(max(unique_clusters)) + 1)
+color_map = cm.get_cmap('tab10', n_colores)
+# dtype unicode de ancho fijo: hashea por contenido en st.cache_data
+# (un array object hashearía por punteros y rompería la clave de cache)
+paleta = np.array([mcolors.to_hex(color_map(i)) for i in range(n_colores)])
 
-# ---------- Resumen + Notificación ----------
-valid = df_cluster[df_cluster["cluster"] != -1]
-summary = (
-    valid.groupby("cluster", as_index=False)
-         .agg(count=("cluster", "size"),
-              lat=("Latitud", "mean"),
-              lon=("Longitud", "mean"),
-              vel_prom=(col_vel, "mean"))
-         .sort_values("count", ascending=False)
+# Mismo tope de marcadores, pero garantizando representación de cada cluster
+df_cluster_vis = df_cluster.groupby("cluster").head(
+    max(1, MAX_MARKERS // max(1, len(unique_clusters)))
 )
+labels = df_cluster_vis["cluster"].to_numpy()
+colores_cluster = np.where(labels == -1, "gray", paleta[np.clip(labels, 0, n_colores - 1)])
+vels_cluster = df_cluster_vis[col_vel].to_numpy()
+popups_cluster = [
+    f"Cluster: {c} | Velocidad: {v:.1f} km/h"
+    for c, v in zip(labels.tolist(), vels_cluster.tolist())
+]
+components.html(
+    build_map_html(
+        (df_cluster["Latitud"].mean(), df_cluster["Longitud"].mean()),
+        df_cluster_vis["Latitud"].to_numpy(),
+        df_cluster_vis["Longitud"].to_numpy(),
+        colores_cluster,
+        popups_cluster,
+    ),
+    height=500,
+)
+
+# ---------- Resumen + Notificación ----------
+# Agregación directa con np.bincount sobre arrays contiguos: evita la
+# materialización de grupos (y su copia) que hace el groupby de pandas
+etiquetas = df_cluster["cluster"].to_numpy()
+mask = etiquetas != -1
+lab = etiquetas[mask]
+lat = df_cluster["Latitud"].to_numpy()[mask]
+lon = df_cluster["Longitud"].to_numpy()[mask]
+vel = df_cluster[col_vel].to_numpy()[mask]
+counts = np.bincount(lab)
+den = np.maximum(counts, 1)
+summary = pd.DataFrame({
+    "cluster": np.arange(len(counts)),
+    "count": counts,
+    "lat": np.bincount(lab, weights=lat) / den,
+    "lon": np.bincount(lab, weights=lon) / den,
+    "vel_prom": np.bincount(lab, weights=vel) / den,
+})
+summary = summary[counts > 0].sort_values("count", ascending=False)
 st.subheader("📋 Resumen de clusters")
 st.dataframe(summary)
 
@@ -194,23 +366,37 @@ if sms_enable and not summary.empty:
         st.info("No hay clusters que cumplan las condiciones para alertar.")
     else:
         try:
-            enviados = 0
-            for _, r in grandes.iterrows():
-                msg = (
-                    f"🚦 Alerta DBSCAN: cluster #{int(r['cluster'])} detectado con "
-                    f"{int(r['count'])} puntos. Centro aprox: ({r['lat']:.5f}, {r['lon']:.5f})"
-                    + (f", vel prom: {r['vel_prom']:.1f} km/h" if usar_filtro_velocidad else "")
-                )
-                sid = send_sms(msg, to_number)
-                enviados += 1
-            st.success(f"SMS enviado(s) para {enviados} cluster(s) que cumplen el criterio.")
+            # itertuples(name=None) entrega tuplas planas, sin el costo de
+            # materializar una Series por fila como hace iterrows
+            mensajes = [
+                f"🚦 Alerta DBSCAN: cluster #{int(c)} detectado con "
+                f"{int(n)} puntos. Centro aprox: ({la:.5f}, {lo:.5f})"
+                + (f", vel prom: {v:.1f} km/h" if usar_filtro_velocidad else "")
+                for c, n, la, lo, v in grandes[
+                    ["cluster", "count", "lat", "lon", "vel_prom"]
+                ].itertuples(index=False, name=None)
+            ]
+            # Cada envío es una ida y vuelta HTTPS (~100-500 ms); el pool los
+            # solapa para que el total sea ~la latencia máxima, no la suma
+            with ThreadPoolExecutor(max_workers=8) as ex:
+                futuros = [ex.submit(send_sms, msg, to_number) for msg in mensajes]
+                sids = [f.result() for f in futuros]
+            st.success(f"SMS enviado(s) para {len(sids)} cluster(s) que cumplen el criterio.")
         except Exception as e:
             st.error(f"❌ Error enviando SMS: {e}")
 
 # ---------- Descarga ----------
 st.subheader("📥 Descargar resultados")
-df_final = df.copy()
-df_final["alerta_microparada"] = df_micro["alerta"]
-df_final["cluster_dbscan"] = df_cluster["cluster"]
-csv = df_final.to_csv(index=False).encode("utf-8")
-st.download_button("Descargar CSV con resultados", csv, "resultados_cluster.csv", "text/csv")
\ No newline at end of file
+# assign comparte los bloques de las columnas originales en vez de
+# duplicar todo el DataFrame solo para agregar dos columnas
+# labels_dbscan conserva el orden original de filas (df_cluster quedó
+# ordenado por etiqueta), así el CSV exportado sigue alineado con df
+df_final = df.assign(
+    alerta_microparada=df_micro["alerta"].to_numpy(),
+    cluster_dbscan=labels_dbscan,
+)
+# Escribimos directo a un BytesIO: un solo buffer, sin el str intermedio
+# ni la copia extra del .encode()
+buf = io.BytesIO()
+df_final.to_csv(buf, index=False)
+st.download_button("Descargar CSV con resultados", buf.getvalue(), "resultados_cluster.csv", "text/csv")
\ No newline at end of file